@@ -4,27 +4,149 @@ Sets up vector database, document processing, and AI pipeline
 """
 
 import os
+import re
 import asyncio
+import contextlib
+import hashlib
 import json
-from typing import List, Dict, Any, Optional
+import logging
+import logging.handlers
+import queue
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import repeat
+from typing import List, Dict, Any, Optional, Tuple
 from datetime import datetime
 import numpy as np
 from sentence_transformers import SentenceTransformer
+import torch
 import faiss
-import PyPDF2
+import aiohttp
+import pypdfium2 as pdfium
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from selectolax.lexbor import LexborHTMLParser
 import youtube_dl
 import openai
 
+try:
+    import diskcache
+except ImportError:  # The embedding cache then only lasts for the lifetime of the process
+    diskcache = None
+
+logger = logging.getLogger(__name__)
+
+# Below this many vectors the int8 quantizer has too small a training sample, so vectors stay float32
+SQ_MIN_TRAINING_VECTORS = 10_000
+# Training the quantizer on more vectors than this barely changes its ranges
+SQ_MAX_TRAINING_VECTORS = 50_000
+
+# Sentence boundaries: whitespace that follows terminal punctuation
+_SENT_RE = re.compile(r'(?<=[.!?])\s+')
+# Subtitle cue numbers and timestamp lines, and inline markup such as VTT <c> and <00:01.000> tags
+_SUB_SKIP_RE = re.compile(r'^(?:\s*\d+\s*|.*-->.*)$', re.MULTILINE)
+_SUB_TAG_RE = re.compile(r'<[^>]*>')
+
+# ONNX exports to try, fastest first: dynamic int8 (AVX2), graph-optimized O3, then the plain export
+ONNX_MODEL_FILES = ("onnx/model_quint8_avx2.onnx", "onnx/model_O3.onnx", None)
+
+USER_AGENT = 'Mozilla/5.0 (compatible; ScriblBot/1.0)'
+# Keep-alive connections held open per host by the shared HTTP clients
+HTTP_POOL_SIZE = 32
+WEB_FETCH_CONNECTIONS = 64
+
+# Saved index files and their metadata database share this path prefix
+DEFAULT_STATE_PATH = "data/scrible_system"
+# Chunk and document metadata, keyed by FAISS embedding ID
+METADATA_DB_PATH = f"{DEFAULT_STATE_PATH}_meta.db"
+
+# Encode batch sizes probed on the GPU at startup; the CPU path always uses the default
+ENCODE_BATCH_SIZES = (16, 32, 64, 128, 256)
+DEFAULT_ENCODE_BATCH_SIZE = 64
+
+# Candidates fetched from the quantized index per requested result, re-scored against FP16 vectors
+RERANK_OVERFETCH = 4
+
+# One queue listener shared by all verbose instances, stopped when the last of them closes
+_log_listener: Optional[logging.handlers.QueueListener] = None
+_log_handler: Optional[logging.handlers.QueueHandler] = None
+_log_users = 0
+
+def configure_logging(level: int = logging.INFO) -> None:
+    """Route this module's log records through a queue so console writes happen off the event loop"""
+    global _log_listener, _log_handler, _log_users
+    _log_users += 1
+    if _log_listener is not None:
+        return
+    
+    log_queue = queue.SimpleQueue()
+    console = logging.StreamHandler()
+    console.setFormatter(logging.Formatter("%(message)s"))
+    _log_listener = logging.handlers.QueueListener(log_queue, console)
+    _log_listener.start()
+    
+    _log_handler = logging.handlers.QueueHandler(log_queue)
+    logger.addHandler(_log_handler)
+    logger.setLevel(level)
+    logger.propagate = False
+
+def release_logging() -> None:
+    """Flush and stop the shared log listener, and detach its handler, once no verbose instance uses it"""
+    global _log_listener, _log_handler, _log_users
+    _log_users -= 1
+    if _log_users > 0 or _log_listener is None:
+        return
+    
+    logger.removeHandler(_log_handler)
+    _log_listener.stop()
+    _log_listener = _log_handler = None
+    logger.setLevel(logging.NOTSET)
+    logger.propagate = True
+
 class ScriblProductionSystem:
-    def __init__(self, openai_api_key: str = None, model_name: str = "all-MiniLM-L6-v2"):
+    def __init__(self, openai_api_key: str = None, model_name: str = "all-MiniLM-L6-v2",
+                 metadata_db_path: str = METADATA_DB_PATH, verbose: bool = False):
         """Initialize the Scrible production system"""
-        self.model = SentenceTransformer(model_name)
+        # Per-document progress is only logged by verbose instances
+        self.verbose = verbose
+        if verbose:
+            configure_logging()
+        self.use_gpu = torch.cuda.is_available()
+        self.model = self.load_embedding_model(model_name)
         self.dimension = self.model.get_sentence_embedding_dimension()
+        self._optimal_bs = self.tune_batch_size()
         self.index = None
+        self._mmapped_index_file = None
+        # With a FAISS GPU build and a visible GPU, the index is an exact flat index held in VRAM
+        self.faiss_gpu_resources = (
+            faiss.StandardGpuResources() if hasattr(faiss, "get_num_gpus") and faiss.get_num_gpus() > 0 else None
+        )
+        # FP16 copies of every vector, used to re-score candidates from the int8 index exactly
+        self.rerank_index = None
+        self._mmapped_rerank_file = None
         self.document_store = {}
-        self.chunk_metadata = []
+        
+        # Chunk metadata lives in SQLite rather than in Python objects, and is committed per document
+        self.metadata_db = None
+        self.open_metadata_db(metadata_db_path)
+        
+        # Extraction and encoding block, so they run here while the event loop keeps fetching
+        self._cpu_pool = ThreadPoolExecutor(max_workers=os.cpu_count())
+        
+        # Shared HTTP clients so repeated fetches reuse keep-alive connections and TLS sessions
+        self._http = requests.Session()
+        self._http.headers.update({'User-Agent': USER_AGENT})
+        adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE, max_retries=3)
+        self._http.mount('https://', adapter)
+        self._http.mount('http://', adapter)
+        # aiohttp sessions belong to the event loop that created them, so this one is opened on first use
+        self._web_session: Optional[aiohttp.ClientSession] = None
+        self._web_session_loop = None
+        
+        # Chunk embeddings keyed by a hash of the chunk text, so repeated text is never re-embedded
+        cache_dir = os.path.join("data/embeddings/_cache", model_name.replace('/', '__'))
+        self._emb_cache = diskcache.Cache(cache_dir) if diskcache is not None else {}
         
         # OpenAI setup
         if openai_api_key:
@@ -40,90 +162,252 @@ class ScriblProductionSystem:
         print(f"📊 Model: {model_name}")
         print(f"🔢 Embedding dimension: {self.dimension}")
     
-    def create_optimized_index(self) -> faiss.Index:
-        """Create production-optimized FAISS index"""
-        # Use HNSW for better performance with large datasets
-        index = faiss.IndexHNSWFlat(self.dimension, 32)
-        index.hnsw.efConstruction = 200
-        index.hnsw.efSearch = 100
+    def open_metadata_db(self, path: str) -> None:
+        """Switch to the metadata database at path, creating it if needed"""
+        if self.metadata_db is not None:
+            self.metadata_db.close()
+        self.metadata_db_path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.metadata_db = sqlite3.connect(path, check_same_thread=False)
+        self.metadata_db.row_factory = sqlite3.Row
+        self.init_metadata_db()
+        # Embedding IDs are handed out sequentially; the chunks table maps each back to its chunk ID
+        self._next_id = self.metadata_db.execute("SELECT COALESCE(MAX(embedding_id) + 1, 0) FROM chunks").fetchone()[0]
+    
+    def init_metadata_db(self) -> None:
+        """Create the document and chunk metadata tables"""
+        self.metadata_db.execute("PRAGMA journal_mode=WAL")
+        self.metadata_db.executescript("""
+            CREATE TABLE IF NOT EXISTS documents (
+                doc_id TEXT PRIMARY KEY,
+                metadata TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS chunks (
+                embedding_id INTEGER PRIMARY KEY,
+                doc_id TEXT NOT NULL,
+                chunk_id TEXT NOT NULL,
+                chunk_index INTEGER NOT NULL,
+                document_name TEXT,
+                document_type TEXT,
+                content TEXT NOT NULL,
+                sentence_count INTEGER,
+                char_count INTEGER,
+                processed_at TEXT
+            );
+        """)
+    
+    def load_embedding_model(self, model_name: str) -> SentenceTransformer:
+        """Load the encoder in FP16 on a GPU, otherwise on ONNX Runtime, falling back to the PyTorch backend"""
+        if self.use_gpu:
+            # Half precision barely moves cosine similarities but roughly doubles GPU throughput
+            print("⚡ CUDA available, running the model on the GPU in FP16")
+            return SentenceTransformer(model_name, device="cuda").half()
+        
+        for file_name in ONNX_MODEL_FILES:
+            model_kwargs = {"provider": "CPUExecutionProvider"}
+            if file_name:
+                model_kwargs["file_name"] = file_name
+            try:
+                model = SentenceTransformer(model_name, backend="onnx", model_kwargs=model_kwargs)
+                print(f"⚡ Loaded ONNX Runtime encoder ({file_name or 'default export'})")
+                return model
+            except Exception as e:
+                # Missing optimum/onnxruntime, sentence-transformers < 3.2, or no such export
+                last_error = e
+        
+        print(f"⚠️  ONNX backend unavailable ({last_error}), using PyTorch")
+        return SentenceTransformer(model_name)
+    
+    def tune_batch_size(self) -> int:
+        """Pick the encode batch size with the best throughput that still fits in GPU memory"""
+        if not self.use_gpu:
+            return DEFAULT_ENCODE_BATCH_SIZE
+        
+        probe_text = "x" * 256
+        self.model.encode([probe_text], convert_to_tensor=True)  # Warm up CUDA kernels
+        
+        best_size, best_rate = DEFAULT_ENCODE_BATCH_SIZE, 0.0
+        for batch_size in ENCODE_BATCH_SIZES:
+            try:
+                start = time.perf_counter()
+                self.model.encode([probe_text] * batch_size, batch_size=batch_size, convert_to_tensor=True)
+                torch.cuda.synchronize()
+                rate = batch_size / (time.perf_counter() - start)
+            except RuntimeError:
+                # CUDA out of memory: larger batches won't fit either
+                torch.cuda.empty_cache()
+                break
+            if rate > best_rate:
+                best_size, best_rate = batch_size, rate
+        
+        print(f"📐 Encode batch size: {best_size} ({best_rate:.0f} texts/s)")
+        return best_size
+    
+    def create_optimized_index(self, training_vectors: Optional[np.ndarray] = None) -> faiss.Index:
+        """Create production-optimized FAISS index, int8-quantized when there is enough data to train on"""
+        if self.faiss_gpu_resources is not None:
+            # Brute force on the GPU adds and searches faster than CPU HNSW, with exact recall
+            index = faiss.IndexIDMap2(faiss.index_cpu_to_gpu(self.faiss_gpu_resources, 0, faiss.IndexFlatL2(self.dimension)))
+            print("🚀 Created exact FAISS GPU flat index")
+            return index
+        
+        if training_vectors is not None and len(training_vectors) >= SQ_MIN_TRAINING_VECTORS:
+            # HNSW over int8 scalar-quantized vectors, a quarter of the float32 storage
+            index = faiss.IndexHNSWSQ(self.dimension, faiss.ScalarQuantizer.QT_8bit, 32)
+            index.hnsw.efConstruction = 200
+            index.hnsw.efSearch = 100
+            index.train(np.ascontiguousarray(training_vectors[:SQ_MAX_TRAINING_VECTORS], dtype='float32'))
+            index_name = "HNSW-SQ8"
+        else:
+            # Use HNSW for better performance with large datasets
+            index = faiss.IndexHNSWFlat(self.dimension, 32)
+            index.hnsw.efConstruction = 200
+            index.hnsw.efSearch = 100
+            index_name = "HNSW"
         
-        # Wrap with IndexIDMap for custom document IDs
-        index = faiss.IndexIDMap(index)
+        # Wrap with IndexIDMap2 for custom document IDs; its reverse map makes reconstruct(id) a lookup
+        index = faiss.IndexIDMap2(index)
         
-        print("🚀 Created optimized FAISS HNSW index")
+        print(f"🚀 Created optimized FAISS {index_name} index")
         return index
     
-    def intelligent_chunking(self, text: str, chunk_size: int = 512, overlap: int = 64) -> List[Dict[str, Any]]:
-        """Advanced text chunking with semantic awareness"""
+    def create_rerank_store(self) -> faiss.Index:
+        """Create the FP16 vector store used to rerank candidates from the quantized index"""
+        # QT_fp16 needs no training; IndexIDMap2 lets candidates be reconstructed by embedding ID
+        return faiss.IndexIDMap2(faiss.IndexScalarQuantizer(self.dimension, faiss.ScalarQuantizer.QT_fp16))
+    
+    def rerank_hits(self, query_embedding: np.ndarray, ids: List[int], k: int) -> List[Tuple[float, int]]:
+        """Re-score candidate IDs by exact L2 distance to their FP16 vectors and keep the best k"""
+        vectors = self.rerank_index.reconstruct_batch(np.array(ids, dtype=np.int64))
+        distances = ((vectors - query_embedding) ** 2).sum(axis=1)
+        order = np.argsort(distances)[:k]
+        return [(float(distances[i]), ids[i]) for i in order]
+    
+    def upgrade_to_quantized_index(self) -> None:
+        """Rebuild a float32 HNSW index as HNSW-SQ8 once it holds enough vectors to train the quantizer"""
+        inner = faiss.downcast_index(self.index.index)
+        if not isinstance(inner, faiss.IndexHNSWFlat) or self.index.ntotal < SQ_MIN_TRAINING_VECTORS:
+            return
+        
+        vectors = inner.reconstruct_n(0, inner.ntotal)
+        ids = faiss.vector_to_array(self.index.id_map)
+        index = self.create_optimized_index(vectors)
+        index.add_with_ids(vectors, ids)
+        self.index = index
+    
+    @staticmethod
+    def intelligent_chunking(text: str, chunk_size: int = 512, overlap: int = 64) -> Tuple[List[str], np.ndarray, np.ndarray]:
+        """Advanced text chunking with semantic awareness, returning chunk texts, sentence counts and char counts"""
         # Split by sentences to maintain semantic coherence
-        sentences = text.replace('\n', ' ').split('. ')
-        chunks = []
-        current_chunk = ""
-        current_sentences = []
-        
-        for i, sentence in enumerate(sentences):
-            sentence = sentence.strip()
-            if not sentence:
-                continue
-                
-            # Check if adding this sentence exceeds chunk size
-            test_chunk = current_chunk + ". " + sentence if current_chunk else sentence
-            
-            if len(test_chunk) > chunk_size and current_chunk:
-                # Finalize current chunk
-                chunk_info = {
-                    "text": current_chunk.strip(),
-                    "sentence_count": len(current_sentences),
-                    "char_count": len(current_chunk),
-                    "start_sentence": current_sentences[0] if current_sentences else "",
-                    "end_sentence": current_sentences[-1] if current_sentences else "",
-                }
-                chunks.append(chunk_info)
-                
-                # Start new chunk with overlap
-                overlap_sentences = current_sentences[-overlap//50:] if len(current_sentences) > overlap//50 else []
-                current_chunk = ". ".join(overlap_sentences)
-                current_sentences = overlap_sentences.copy()
-                
-            current_chunk = test_chunk
-            current_sentences.append(sentence)
-        
-        # Add final chunk
-        if current_chunk.strip():
-            chunk_info = {
-                "text": current_chunk.strip(),
-                "sentence_count": len(current_sentences),
-                "char_count": len(current_chunk),
-                "start_sentence": current_sentences[0] if current_sentences else "",
-                "end_sentence": current_sentences[-1] if current_sentences else "",
-            }
-            chunks.append(chunk_info)
+        sentences = [s for s in (s.strip() for s in _SENT_RE.split(text.replace('\n', ' '))) if s]
+        if not sentences:
+            return [], np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+        
+        # offsets[k] is the length of sentences[:k] joined by single spaces, plus one
+        lengths = np.fromiter((len(s) + 1 for s in sentences), dtype=np.int64, count=len(sentences))
+        offsets = np.concatenate(([0], np.cumsum(lengths)))
+        
+        texts, starts, ends = [], [], []
+        start = 0
+        while start < len(sentences):
+            # Take as many whole sentences as fit, but always at least one
+            end = int(np.searchsorted(offsets, offsets[start] + chunk_size + 1, side='right')) - 1
+            end = max(end, start + 1)
+            
+            texts.append(" ".join(sentences[start:end]))
+            starts.append(start)
+            ends.append(end)
+            
+            if end == len(sentences):
+                break
+            # Start the next chunk with the trailing sentences covering the overlap
+            overlap_start = int(np.searchsorted(offsets, offsets[end] - overlap, side='right')) - 1
+            start = max(overlap_start, start + 1)
         
-        return chunks
+        # Per-chunk counts as arrays rather than one dict per chunk
+        starts, ends = np.array(starts), np.array(ends)
+        return texts, ends - starts, offsets[ends] - offsets[starts] - 1
+    
+    def embed_chunks(self, chunk_texts: List[str]) -> np.ndarray:
+        """Embed chunk texts, running the model only on texts missing from the embedding cache"""
+        embeddings = np.empty((len(chunk_texts), self.dimension), dtype='float32')
+        
+        # Positions of every uncached text, grouped by key so duplicates are embedded once
+        misses: Dict[str, List[int]] = {}
+        for i, text in enumerate(chunk_texts):
+            key = hashlib.blake2b(text.encode(), digest_size=16).hexdigest()
+            cached = self._emb_cache.get(key)
+            if cached is None:
+                misses.setdefault(key, []).append(i)
+            else:
+                embeddings[i] = cached
+        
+        if misses:
+            miss_texts = [chunk_texts[positions[0]] for positions in misses.values()]
+            
+            # Encode shortest-first so each batch pads to a similar length, then undo the ordering
+            order = np.argsort([len(text) for text in miss_texts], kind='stable')
+            sorted_texts = [miss_texts[i] for i in order]
+            if self.use_gpu:
+                # Normalize on the GPU and copy back once, upcasting the FP16 output
+                sorted_embeddings = self.model.encode(
+                    sorted_texts,
+                    convert_to_tensor=True,
+                    normalize_embeddings=True,
+                    show_progress_bar=False,
+                    batch_size=self._optimal_bs
+                ).float().cpu().numpy()
+            else:
+                sorted_embeddings = self.model.encode(
+                    sorted_texts,
+                    convert_to_numpy=True,
+                    show_progress_bar=False,
+                    batch_size=self._optimal_bs
+                )
+            computed = np.empty_like(sorted_embeddings)
+            computed[order] = sorted_embeddings
+            
+            # Stored as float16 to halve the cache size
+            with self._emb_cache.transact() if diskcache is not None else contextlib.nullcontext():
+                for (key, positions), vector in zip(misses.items(), computed):
+                    embeddings[positions] = vector
+                    self._emb_cache[key] = vector.astype(np.float16)
+        
+        if self.verbose:
+            logger.info("🧠 Embedded %d chunks (%d from cache)",
+                        len(chunk_texts), len(chunk_texts) - sum(map(len, misses.values())))
+        return embeddings
     
     def extract_pdf_content(self, pdf_path: str) -> Dict[str, Any]:
-        """Extract text content from PDF using PyPDF2"""
+        """Extract text content from PDF using PDFium"""
         try:
-            with open(pdf_path, 'rb') as file:
-                pdf_reader = PyPDF2.PdfReader(file)
-                text = ""
-                
-                for page_num, page in enumerate(pdf_reader.pages):
-                    text += page.extract_text() + "\n"
-                
-                metadata = {
-                    "page_count": len(pdf_reader.pages),
-                    "word_count": len(text.split()),
-                    "char_count": len(text),
-                    "language": "en",  # Could be detected
-                    "extraction_method": "PyPDF2"
-                }
-                
-                return {
-                    "content": text.strip(),
-                    "metadata": metadata,
-                    "success": True
-                }
+            pdf = pdfium.PdfDocument(pdf_path)
+            try:
+                # Pages are extracted one at a time and released, then joined once
+                pages = []
+                for page in pdf:
+                    textpage = page.get_textpage()
+                    pages.append(textpage.get_text_range())
+                    textpage.close()
+                    page.close()
+            finally:
+                pdf.close()
+            
+            text = "\n".join(pages)
+            
+            metadata = {
+                "page_count": len(pages),
+                "word_count": len(text.split()),
+                "char_count": len(text),
+                "language": "en",  # Could be detected
+                "extraction_method": "pypdfium2"
+            }
+            
+            return {
+                "content": text.strip(),
+                "metadata": metadata,
+                "success": True
+            }
         except Exception as e:
             return {
                 "content": "",
@@ -132,38 +416,83 @@ class ScriblProductionSystem:
                 "error": str(e)
             }
     
-    def extract_web_content(self, url: str) -> Dict[str, Any]:
-        """Extract content from web pages using BeautifulSoup"""
+    def get_web_session(self) -> aiohttp.ClientSession:
+        """Return the shared aiohttp session, opening one for the running event loop if needed"""
+        loop = asyncio.get_running_loop()
+        if self._web_session is not None and not self._web_session.closed and self._web_session_loop is not loop:
+            # The open session can only be closed on its own loop, and replacing it would leak its connections
+            raise RuntimeError("Web session belongs to another event loop; close() the system on that loop first")
+        if self._web_session is None or self._web_session.closed:
+            self._web_session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=WEB_FETCH_CONNECTIONS),
+                headers={'User-Agent': USER_AGENT},
+                timeout=aiohttp.ClientTimeout(total=30)
+            )
+            self._web_session_loop = loop
+        return self._web_session
+    
+    async def __aenter__(self) -> "ScriblProductionSystem":
+        """Use the system as an async context manager, closed on the loop that used it"""
+        return self
+    
+    async def __aexit__(self, *exc_info) -> None:
+        """Close the HTTP clients and release logging when the block exits"""
+        await self.close()
+    
+    async def close(self) -> None:
+        """Close the shared HTTP clients and flush pending log output"""
+        if self._web_session is not None and not self._web_session.closed:
+            await self._web_session.close()
+        self._http.close()
+        if self.verbose:
+            release_logging()
+            # Releases the shared listener only once, even if close() is called again
+            self.verbose = False
+    
+    async def extract_web_content(self, url: str) -> Dict[str, Any]:
+        """Extract content from web pages using selectolax"""
         try:
-            headers = {
-                'User-Agent': 'Mozilla/5.0 (compatible; ScriblBot/1.0)'
-            }
+            async with self.get_web_session().get(url) as response:
+                response.raise_for_status()
+                html = await response.read()
             
-            response = requests.get(url, headers=headers, timeout=30)
-            response.raise_for_status()
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._cpu_pool, self.parse_web_content, url, html)
             
-            soup = BeautifulSoup(response.content, 'html.parser')
+        except Exception as e:
+            return {
+                "content": "",
+                "metadata": {},
+                "success": False,
+                "error": str(e)
+            }
+    
+    def parse_web_content(self, url: str, html: bytes) -> Dict[str, Any]:
+        """Parse the readable content out of a fetched web page"""
+        try:
+            # Lexbor-backed C parser, far faster than BeautifulSoup's html.parser
+            tree = LexborHTMLParser(html)
             
             # Remove script and style elements
-            for script in soup(["script", "style"]):
+            for script in tree.css("script, style"):
                 script.decompose()
             
             # Extract title
-            title = soup.find('title')
-            title_text = title.get_text().strip() if title else "No title"
+            title = tree.css_first('title')
+            title_text = title.text().strip() if title else "No title"
             
             # Extract main content (prioritize article, main, or body)
             content_selectors = ['article', 'main', '[role="main"]', '.content', '#content', 'body']
             content = ""
             
             for selector in content_selectors:
-                elements = soup.select(selector)
-                if elements:
-                    content = elements[0].get_text()
+                node = tree.css_first(selector)
+                if node:
+                    content = node.text()
                     break
             
-            if not content:
-                content = soup.get_text()
+            if not content and tree.root is not None:
+                content = tree.root.text()
             
             # Clean up content
             lines = (line.strip() for line in content.splitlines())
@@ -175,7 +504,7 @@ class ScriblProductionSystem:
                 "domain": requests.utils.urlparse(url).netloc,
                 "word_count": len(content.split()),
                 "char_count": len(content),
-                "extraction_method": "BeautifulSoup"
+                "extraction_method": "selectolax"
             }
             
             return {
@@ -221,12 +550,12 @@ class ScriblProductionSystem:
                 if 'en' in subtitles:
                     # Download and parse subtitle file
                     subtitle_url = subtitles['en'][0]['url']
-                    subtitle_response = requests.get(subtitle_url)
+                    subtitle_response = self._http.get(subtitle_url)
                     transcript = self.parse_subtitle_content(subtitle_response.text)
                 elif 'en' in auto_captions:
                     # Use auto-generated captions
                     caption_url = auto_captions['en'][0]['url']
-                    caption_response = requests.get(caption_url)
+                    caption_response = self._http.get(caption_url)
                     transcript = self.parse_subtitle_content(caption_response.text)
                 else:
                     # Fallback to description if no transcript available
@@ -259,16 +588,9 @@ class ScriblProductionSystem:
     def parse_subtitle_content(self, subtitle_text: str) -> str:
         """Parse subtitle/caption content to extract clean text"""
         # This is a simplified parser - in production, use proper subtitle parsers
-        lines = subtitle_text.split('\n')
-        text_lines = []
-        
-        for line in lines:
-            line = line.strip()
-            # Skip timestamp lines and empty lines
-            if line and not line.startswith('<') and '-->' not in line and not line.isdigit():
-                text_lines.append(line)
-        
-        return ' '.join(text_lines)
+        text = _SUB_SKIP_RE.sub('', subtitle_text)
+        text = _SUB_TAG_RE.sub('', text)
+        return ' '.join(text.split())
     
     async def process_document_async(self, document: Dict[str, Any]) -> Dict[str, Any]:
         """Process a document with full RAG pipeline"""
@@ -277,16 +599,19 @@ class ScriblProductionSystem:
         doc_path = document.get('path', '')
         doc_url = document.get('url', '')
         
-        print(f"🔄 Processing document: {doc_id} ({doc_type})")
+        if self.verbose:
+            logger.info("🔄 Processing document: %s (%s)", doc_id, doc_type)
         
         try:
+            loop = asyncio.get_running_loop()
+            
             # Step 1: Extract content based on type
             if doc_type == 'pdf':
-                extraction_result = self.extract_pdf_content(doc_path)
+                extraction_result = await loop.run_in_executor(self._cpu_pool, self.extract_pdf_content, doc_path)
             elif doc_type == 'url':
-                extraction_result = self.extract_web_content(doc_url)
+                extraction_result = await self.extract_web_content(doc_url)
             elif doc_type == 'youtube':
-                extraction_result = self.extract_youtube_content(doc_url)
+                extraction_result = await loop.run_in_executor(self._cpu_pool, self.extract_youtube_content, doc_url)
             else:
                 raise ValueError(f"Unsupported document type: {doc_type}")
             
@@ -300,57 +625,66 @@ class ScriblProductionSystem:
             metadata = extraction_result['metadata']
             
             # Step 2: Intelligent chunking
-            chunks = self.intelligent_chunking(content)
-            print(f"📝 Created {len(chunks)} semantic chunks")
+            chunk_texts, sentence_counts, char_counts = self.intelligent_chunking(content)
+            if self.verbose:
+                logger.info("📝 Created %d semantic chunks for %s", len(chunk_texts), doc_id)
             
             # Step 3: Generate embeddings
-            chunk_texts = [chunk["text"] for chunk in chunks]
-            embeddings = self.model.encode(
-                chunk_texts, 
-                convert_to_tensor=False, 
-                show_progress_bar=True,
-                batch_size=32
-            )
+            embeddings = await loop.run_in_executor(self._cpu_pool, self.embed_chunks, chunk_texts)
             
-            # Step 4: Normalize embeddings for cosine similarity
-            embeddings = embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+            # Step 4: Normalize embeddings for cosine similarity, in place on the float32 buffer
+            faiss.normalize_L2(embeddings)
+            
+            # Generate unique IDs for chunks
+            chunk_ids = [f"{doc_id}_chunk_{i}" for i in range(len(chunk_texts))]
+            numeric_ids = np.arange(self._next_id, self._next_id + len(chunk_ids), dtype=np.int64)
+            self._next_id += len(chunk_ids)
+            
+            # Step 5: Store metadata, committed before any vector can be found by search
+            processed_at = datetime.now().isoformat()
+            with self.metadata_db:
+                self.metadata_db.execute(
+                    "INSERT OR REPLACE INTO documents (doc_id, metadata) VALUES (?, ?)",
+                    (doc_id, json.dumps(metadata))
+                )
+                self.metadata_db.executemany(
+                    "INSERT OR REPLACE INTO chunks (embedding_id, doc_id, chunk_id, chunk_index, document_name, "
+                    "document_type, content, sentence_count, char_count, processed_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    zip(
+                        numeric_ids.tolist(), repeat(doc_id), chunk_ids, range(len(chunk_ids)),
+                        repeat(document.get('name', 'Unknown')), repeat(doc_type), chunk_texts,
+                        sentence_counts.tolist(), char_counts.tolist(), repeat(processed_at)
+                    )
+                )
             
-            # Step 5: Store in vector database
+            # Step 6: Store in vector database
             if self.index is None:
                 self.index = self.create_optimized_index()
-            
-            # Generate unique IDs for chunks
-            chunk_ids = [f"{doc_id}_chunk_{i}" for i in range(len(chunks))]
-            numeric_ids = np.array([hash(chunk_id) % (2**31) for chunk_id in chunk_ids], dtype=np.int64)
+                # Exact GPU search has nothing to rerank
+                self.rerank_index = self.create_rerank_store() if self.faiss_gpu_resources is None else None
+            elif self._mmapped_index_file is not None:
+                # Memory-mapped indexes cannot grow, so read them into memory before adding to them
+                self.index = faiss.read_index(self._mmapped_index_file)
+                self._mmapped_index_file = None
+            if self._mmapped_rerank_file is not None:
+                # Same for the rerank store, which can stay mapped independently of the index
+                self.rerank_index = faiss.read_index(self._mmapped_rerank_file)
+                self._mmapped_rerank_file = None
             
             # Add to FAISS index
-            self.index.add_with_ids(embeddings.astype('float32'), numeric_ids)
-            
-            # Step 6: Store metadata
-            for i, (chunk, chunk_id) in enumerate(zip(chunks, chunk_ids)):
-                chunk_metadata = {
-                    'doc_id': doc_id,
-                    'chunk_id': chunk_id,
-                    'chunk_index': i,
-                    'document_name': document.get('name', 'Unknown'),
-                    'document_type': doc_type,
-                    'content': chunk["text"],
-                    'sentence_count': chunk["sentence_count"],
-                    'char_count': chunk["char_count"],
-                    'embedding_id': int(numeric_ids[i]),
-                    'processed_at': datetime.now().isoformat(),
-                    'metadata': metadata
-                }
-                self.chunk_metadata.append(chunk_metadata)
+            self.index.add_with_ids(embeddings, numeric_ids)
+            if self.rerank_index is not None:
+                self.rerank_index.add_with_ids(embeddings, numeric_ids)
+            self.upgrade_to_quantized_index()
             
-            # Step 7: Generate summary using OpenAI
-            summary = await self.generate_summary(content, metadata)
-            key_points = await self.extract_key_points(content, metadata)
+            # Step 7: Generate summary and key points in one OpenAI round-trip
+            summary, key_points = await self.analyze_document(content, metadata)
             
             result = {
                 "status": "completed",
                 "doc_id": doc_id,
-                "chunks_created": len(chunks),
+                "chunks_created": len(chunk_texts),
                 "embeddings_generated": len(embeddings),
                 "summary": summary,
                 "key_points": key_points,
@@ -358,7 +692,8 @@ class ScriblProductionSystem:
                 "processing_time": datetime.now().isoformat(),
             }
             
-            print(f"✅ Successfully processed document: {doc_id}")
+            if self.verbose:
+                logger.info("✅ Successfully processed document: %s", doc_id)
             return result
             
         except Exception as e:
@@ -366,11 +701,23 @@ class ScriblProductionSystem:
             print(f"❌ {error_msg}")
             return {"status": "failed", "error": error_msg}
     
-    async def generate_summary(self, content: str, metadata: Dict) -> str:
-        """Generate intelligent summary using OpenAI"""
+    async def process_documents(self, documents: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Process several documents concurrently so downloads overlap with extraction and encoding"""
+        results = await asyncio.gather(
+            *(self.process_document_async(document) for document in documents),
+            return_exceptions=True
+        )
+        return [
+            {"status": "failed", "error": f"Failed to process document {document['id']}: {result}"}
+            if isinstance(result, Exception) else result
+            for document, result in zip(documents, results)
+        ]
+    
+    async def analyze_document(self, content: str, metadata: Dict) -> Tuple[str, List[str]]:
+        """Generate a summary and key points in a single OpenAI request, falling back per field"""
         try:
             if not openai.api_key:
-                return self.generate_fallback_summary(content, metadata)
+                return self.generate_fallback_summary(content, metadata), self.extract_fallback_key_points(content)
             
             # Truncate content if too long
             max_content_length = 6000
@@ -379,26 +726,34 @@ class ScriblProductionSystem:
                 truncated_content += "... [content truncated]"
             
             response = await openai.ChatCompletion.acreate(
-                model="gpt-4",
+                model="gpt-4o-mini",
                 messages=[
                     {
                         "role": "system",
-                        "content": "You are an expert research assistant. Provide a comprehensive but concise summary of the given content, highlighting key themes, main arguments, and important findings."
+                        "content": "You are an expert research assistant. Reply with a JSON object with two fields: \"summary\", a comprehensive but concise summary of the given content highlighting key themes, main arguments, and important findings; and \"key_points\", a list of 4-6 concise, important insights or findings."
                     },
                     {
                         "role": "user",
-                        "content": f"Please summarize this content:\n\nTitle: {metadata.get('title', 'N/A')}\nType: {metadata.get('extraction_method', 'N/A')}\n\nContent:\n{truncated_content}"
+                        "content": f"Please analyze this content:\n\nTitle: {metadata.get('title', 'N/A')}\nType: {metadata.get('extraction_method', 'N/A')}\n\nContent:\n{truncated_content}"
                     }
                 ],
-                max_tokens=300,
+                response_format={"type": "json_object"},
+                max_tokens=500,
                 temperature=0.3
             )
             
-            return response.choices[0].message.content.strip()
+            analysis = json.loads(response.choices[0].message.content)
+            summary = str(analysis.get("summary") or "").strip()
+            key_points = [str(point).strip() for point in analysis.get("key_points") or [] if str(point).strip()]
+            
+            return (
+                summary or self.generate_fallback_summary(content, metadata),
+                key_points[:6] or self.extract_fallback_key_points(content)  # Limit to 6 points
+            )
             
         except Exception as e:
-            print(f"OpenAI summary generation failed: {e}")
-            return self.generate_fallback_summary(content, metadata)
+            print(f"OpenAI document analysis failed: {e}")
+            return self.generate_fallback_summary(content, metadata), self.extract_fallback_key_points(content)
     
     def generate_fallback_summary(self, content: str, metadata: Dict) -> str:
         """Generate fallback summary without OpenAI"""
@@ -413,50 +768,6 @@ class ScriblProductionSystem:
         else:
             return f"Comprehensive {doc_type} titled '{title}' ({word_count} words) with extensive analysis covering multiple topics and detailed insights."
     
-    async def extract_key_points(self, content: str, metadata: Dict) -> List[str]:
-        """Extract key points using OpenAI or fallback method"""
-        try:
-            if not openai.api_key:
-                return self.extract_fallback_key_points(content)
-            
-            # Truncate content if too long
-            max_content_length = 6000
-            truncated_content = content[:max_content_length]
-            
-            response = await openai.ChatCompletion.acreate(
-                model="gpt-4",
-                messages=[
-                    {
-                        "role": "system",
-                        "content": "Extract 4-6 key points from the given content. Each point should be a concise, important insight or finding. Return as a numbered list."
-                    },
-                    {
-                        "role": "user",
-                        "content": f"Extract key points from:\n\n{truncated_content}"
-                    }
-                ],
-                max_tokens=200,
-                temperature=0.3
-            )
-            
-            key_points_text = response.choices[0].message.content.strip()
-            
-            # Parse the numbered list
-            key_points = []
-            for line in key_points_text.split('\n'):
-                line = line.strip()
-                if line and (line[0].isdigit() or line.startswith('-') or line.startswith('•')):
-                    # Remove numbering/bullets
-                    clean_point = line.split('.', 1)[-1].strip() if '.' in line else line[1:].strip()
-                    if clean_point:
-                        key_points.append(clean_point)
-            
-            return key_points[:6]  # Limit to 6 points
-            
-        except Exception as e:
-            print(f"OpenAI key points extraction failed: {e}")
-            return self.extract_fallback_key_points(content)
-    
     def extract_fallback_key_points(self, content: str) -> List[str]:
         """Extract key points using simple heuristics"""
         # Simple keyword-based extraction
@@ -504,34 +815,49 @@ class ScriblProductionSystem:
     
     async def semantic_search(self, query: str, k: int = 10) -> List[Dict[str, Any]]:
         """Perform semantic search across all documents"""
-        if self.index is None or len(self.chunk_metadata) == 0:
+        if self.index is None or self.index.ntotal == 0:
             return []
         
         try:
             # Generate query embedding
-            query_embedding = self.model.encode([query], convert_to_tensor=False)
-            query_embedding = query_embedding / np.linalg.norm(query_embedding, axis=1, keepdims=True)
+            query_embedding = self.model.encode([query], convert_to_numpy=True, normalize_embeddings=True)
+            query_embedding = np.ascontiguousarray(query_embedding, dtype=np.float32)
+            
+            # Over-fetch from the int8 index so exact reranking can recover what quantization misordered
+            rerank = self.rerank_index is not None and isinstance(faiss.downcast_index(self.index.index), faiss.IndexHNSWSQ)
             
             # Search in FAISS index
-            scores, indices = self.index.search(query_embedding.astype('float32'), k)
+            scores, indices = self.index.search(query_embedding, k * RERANK_OVERFETCH if rerank else k)
+            
+            hits = [(float(score), int(idx)) for score, idx in zip(scores[0], indices[0]) if idx != -1]
+            if not hits:
+                return []
+            if rerank:
+                hits = self.rerank_hits(query_embedding[0], [idx for _, idx in hits], k)
+            
+            # Fetch metadata for every hit in one primary-key lookup
+            placeholders = ", ".join("?" * len(hits))
+            rows = self.metadata_db.execute(
+                "SELECT c.*, d.metadata FROM chunks c JOIN documents d ON d.doc_id = c.doc_id "
+                f"WHERE c.embedding_id IN ({placeholders})",
+                [idx for _, idx in hits]
+            ).fetchall()
+            rows_by_id = {row['embedding_id']: row for row in rows}
             
             results = []
-            for score, idx in zip(scores[0], indices[0]):
-                if idx != -1:  # Valid result
-                    # Find metadata by embedding ID
-                    for metadata in self.chunk_metadata:
-                        if metadata['embedding_id'] == idx:
-                            results.append({
-                                'content': metadata['content'],
-                                'document_name': metadata['document_name'],
-                                'document_type': metadata['document_type'],
-                                'chunk_index': metadata['chunk_index'],
-                                'similarity_score': float(score),
-                                'doc_id': metadata['doc_id'],
-                                'chunk_id': metadata['chunk_id'],
-                                'metadata': metadata.get('metadata', {})
-                            })
-                            break
+            for score, idx in hits:
+                row = rows_by_id.get(idx)
+                if row:
+                    results.append({
+                        'content': row['content'],
+                        'document_name': row['document_name'],
+                        'document_type': row['document_type'],
+                        'chunk_index': row['chunk_index'],
+                        'similarity_score': score,
+                        'doc_id': row['doc_id'],
+                        'chunk_id': row['chunk_id'],
+                        'metadata': json.loads(row['metadata'])
+                    })
             
             return results
         except Exception as e:
@@ -604,14 +930,83 @@ class ScriblProductionSystem:
                 "confidence": 0.0
             }
     
-    def save_system_state(self, filepath: str = "data/scrible_system") -> None:
+    def save_system_state(self, filepath: str = DEFAULT_STATE_PATH) -> None:
         """Save the complete system state"""
         try:
-            if self.index is not None:
-                faiss.write_index(self.index, f"{filepath}.faiss")
+            if self._mmapped_index_file == f"{filepath}.faiss":
+                # Unchanged since it was mapped, and rewriting a mapped file would corrupt the mapping
+                print(f"💾 FAISS index at {filepath}.faiss is unchanged")
+            elif self.index is not None:
+                # GPU indexes are copied back to host memory to be serialized
+                index = faiss.index_gpu_to_cpu(self.index) if self.faiss_gpu_resources is not None else self.index
+                faiss.write_index(index, f"{filepath}.faiss")
                 print(f"💾 Saved FAISS index to {filepath}.faiss")
             
-            # Save metadata
-            with open(f"{filepath}_metadata.json", 'w') as f:
-                json.dump(self.chunk_metadata, f, indent=2)
-            print(f"💾 Saved metadata to {filepath}_metadata
+            if self._mmapped_rerank_file == f"{filepath}_rerank.faiss":
+                print(f"💾 Rerank vectors at {filepath}_rerank.faiss are unchanged")
+            elif self.rerank_index is not None:
+                faiss.write_index(self.rerank_index, f"{filepath}_rerank.faiss")
+                print(f"💾 Saved rerank vectors to {filepath}_rerank.faiss")
+            
+            # Metadata is already committed to SQLite as each document is stored; saving elsewhere copies it
+            db_path = f"{filepath}_meta.db"
+            if os.path.abspath(db_path) == os.path.abspath(self.metadata_db_path):
+                print(f"💾 Metadata is stored in {db_path}")
+            else:
+                destination = sqlite3.connect(db_path)
+                try:
+                    self.metadata_db.backup(destination)
+                finally:
+                    destination.close()
+                print(f"💾 Copied metadata to {db_path}")
+            
+        except Exception as e:
+            print(f"❌ Failed to save system state: {e}")
+    
+    def load_system_state(self, filepath: str = DEFAULT_STATE_PATH) -> bool:
+        """Load a saved FAISS index, memory-mapping its vector storage"""
+        try:
+            index_file = f"{filepath}.faiss"
+            if not os.path.exists(index_file):
+                print(f"⚠️  No saved index found at {index_file}")
+                return False
+            
+            # Vectors are paged in by the OS on demand; FAISS builds without IO_FLAG_MMAP_IFC read them up front
+            mmap_flag = getattr(faiss, "IO_FLAG_MMAP_IFC", faiss.IO_FLAG_MMAP)
+            self.index = faiss.read_index(index_file, mmap_flag)
+            self._mmapped_index_file = index_file
+            
+            # The metadata saved alongside this index, so embedding IDs and chunk rows belong together
+            db_path = f"{filepath}_meta.db"
+            if os.path.exists(db_path) and os.path.abspath(db_path) != os.path.abspath(self.metadata_db_path):
+                self.open_metadata_db(db_path)
+            # New IDs must not collide with vectors already in the index, even if the database lags behind it
+            index_ids = faiss.vector_to_array(self.index.id_map)
+            if len(index_ids):
+                self._next_id = max(self._next_id, int(index_ids.max()) + 1)
+            
+            rerank_file = f"{filepath}_rerank.faiss"
+            if self.faiss_gpu_resources is not None and isinstance(faiss.downcast_index(self.index.index), faiss.IndexFlat):
+                # A flat index saved from the GPU goes back into VRAM rather than staying mapped;
+                # the ID map wrapper is cloned along with it
+                self.index = faiss.index_cpu_to_gpu(self.faiss_gpu_resources, 0, self.index)
+                self._mmapped_index_file = None
+                # Exact GPU search has nothing to rerank, so a rerank file from an earlier CPU save is not mapped
+                self.rerank_index = None
+                self._mmapped_rerank_file = None
+            elif os.path.exists(rerank_file):
+                self.rerank_index = faiss.read_index(rerank_file, mmap_flag)
+                self._mmapped_rerank_file = rerank_file
+            else:
+                # Saved before reranking existed; results then come straight from the index
+                self.rerank_index = None
+                self._mmapped_rerank_file = None
+            
+            chunk_count = self.metadata_db.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+            how = "Memory-mapped" if self._mmapped_index_file else "Loaded"
+            print(f"📂 {how} FAISS index from {index_file}: {self.index.ntotal} vectors, {chunk_count} chunks")
+            return True
+            
+        except Exception as e:
+            print(f"❌ Failed to load system state: {e}")
+            return False
@@ -4,6 +4,7 @@ This script sets up a complete vector search system with real embeddings
 """
 
 import os
+import re
 import json
 import numpy as np
 from typing import List, Dict, Any, Optional
@@ -13,6 +14,14 @@ from sentence_transformers import SentenceTransformer
 import faiss
 from datetime import datetime
 
+# Sentence boundaries: whitespace that follows terminal punctuation
+_SENT_RE = re.compile(r'(?<=[.!?])\s+')
+
+# Below this many vectors the int8 quantizer has too small a training sample, so vectors stay float32
+SQ_MIN_TRAINING_VECTORS = 10_000
+# Training the quantizer on more vectors than this barely changes its ranges
+SQ_MAX_TRAINING_VECTORS = 50_000
+
 class ProductionVectorDB:
     def __init__(self, model_name: str = "all-MiniLM-L6-v2", index_path: str = "data/production_index"):
         """Initialize production vector database"""
@@ -29,40 +38,64 @@ class ProductionVectorDB:
         print(f"Initialized ProductionVectorDB with model: {model_name}")
         print(f"Embedding dimension: {self.dimension}")
     
-    def create_index(self) -> faiss.Index:
+    def create_index(self, training_vectors: Optional[np.ndarray] = None) -> faiss.Index:
         """Create optimized FAISS index for production"""
-        # Use IndexHNSWFlat for better performance with large datasets
-        index = faiss.IndexHNSWFlat(self.dimension, 32)  # 32 is M parameter
-        index.hnsw.efConstruction = 200  # Higher value = better recall, slower build
-        index.hnsw.efSearch = 100  # Higher value = better recall, slower search
+        if training_vectors is not None and len(training_vectors) >= SQ_MIN_TRAINING_VECTORS:
+            # IndexHNSWSQ stores int8 scalar-quantized vectors, a quarter of the float32 size
+            index = faiss.IndexHNSWSQ(self.dimension, faiss.ScalarQuantizer.QT_8bit, 32)
+            index.hnsw.efConstruction = 200  # Higher value = better recall, slower build
+            index.hnsw.efSearch = 100  # Higher value = better recall, slower search
+            index.train(np.ascontiguousarray(training_vectors[:SQ_MAX_TRAINING_VECTORS], dtype='float32'))
+            index_name = "HNSW-SQ8"
+        else:
+            # Use IndexHNSWFlat until there are enough vectors to train the quantizer
+            index = faiss.IndexHNSWFlat(self.dimension, 32)  # 32 is M parameter
+            index.hnsw.efConstruction = 200  # Higher value = better recall, slower build
+            index.hnsw.efSearch = 100  # Higher value = better recall, slower search
+            index_name = "HNSW"
         
         # Wrap with IndexIDMap for custom document IDs
         index = faiss.IndexIDMap(index)
         
-        print("Created optimized FAISS HNSW index for production")
+        print(f"Created optimized FAISS {index_name} index for production")
         return index
     
+    def upgrade_to_quantized_index(self) -> None:
+        """Rebuild a float32 HNSW index as HNSW-SQ8 once it holds enough vectors to train the quantizer"""
+        inner = faiss.downcast_index(self.index.index)
+        if not isinstance(inner, faiss.IndexHNSWFlat) or self.index.ntotal < SQ_MIN_TRAINING_VECTORS:
+            return
+        
+        vectors = inner.reconstruct_n(0, inner.ntotal)
+        ids = faiss.vector_to_array(self.index.id_map)
+        index = self.create_index(vectors)
+        index.add_with_ids(vectors, ids)
+        self.index = index
+    
     def chunk_text(self, text: str, chunk_size: int = 512, overlap: int = 64) -> List[str]:
         """Split text into overlapping chunks optimized for embeddings"""
         # Split by sentences first to maintain semantic coherence
-        sentences = text.replace('\n', ' ').split('. ')
+        sentences = [s for s in (s.strip() for s in _SENT_RE.split(text.replace('\n', ' '))) if s]
+        if not sentences:
+            return []
+        
+        # offsets[k] is the length of sentences[:k] joined by single spaces, plus one
+        lengths = np.fromiter((len(s) + 1 for s in sentences), dtype=np.int64, count=len(sentences))
+        offsets = np.concatenate(([0], np.cumsum(lengths)))
+        
         chunks = []
-        current_chunk = ""
-        
-        for sentence in sentences:
-            # Check if adding this sentence would exceed chunk size
-            if len(current_chunk) + len(sentence) > chunk_size and current_chunk:
-                chunks.append(current_chunk.strip())
-                # Start new chunk with overlap
-                words = current_chunk.split()
-                overlap_text = ' '.join(words[-overlap//4:]) if len(words) > overlap//4 else ""
-                current_chunk = overlap_text + " " + sentence if overlap_text else sentence
-            else:
-                current_chunk += ". " + sentence if current_chunk else sentence
-        
-        # Add the last chunk
-        if current_chunk.strip():
-            chunks.append(current_chunk.strip())
+        start = 0
+        while start < len(sentences):
+            # Take as many whole sentences as fit, but always at least one
+            end = int(np.searchsorted(offsets, offsets[start] + chunk_size + 1, side='right')) - 1
+            end = max(end, start + 1)
+            chunks.append(" ".join(sentences[start:end]))
+            
+            if end == len(sentences):
+                break
+            # Start the next chunk with the trailing sentences covering the overlap
+            overlap_start = int(np.searchsorted(offsets, offsets[end] - overlap, side='right')) - 1
+            start = max(overlap_start, start + 1)
         
         return chunks
     
@@ -86,4 +119,19 @@ class ProductionVectorDB:
         embeddings = self.model.encode(chunks, convert_to_tensor=False, show_progress_bar=True)
         
         # Normalize embeddings for cosine similarity
-        embeddings = embeddings / np.l
+        embeddings = embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+        
+        # Add to FAISS index, keeping each chunk's metadata under its embedding ID
+        ids = np.arange(len(self.chunk_metadata), len(self.chunk_metadata) + len(chunks), dtype=np.int64)
+        self.index.add_with_ids(embeddings.astype('float32'), ids)
+        self.upgrade_to_quantized_index()
+        
+        for i, chunk in enumerate(chunks):
+            self.chunk_metadata.append({
+                'doc_id': doc_id,
+                'chunk_index': i,
+                'content': chunk,
+                'embedding_id': int(ids[i]),
+            })
+        
+        print(f"Added {len(chunks)} chunks from document {doc_id} to the index")